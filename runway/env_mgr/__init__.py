@@ -4,6 +4,8 @@ import os
 import platform
 import sys
 
+import requests
+
 from ..util import cached_property
 
 if sys.version_info[0] > 2:  # TODO remove after droping python 2
@@ -16,7 +18,9 @@ LOGGER = logging.getLogger(__name__)
 
 def handle_bin_download_error(exc, name):
     """Give user info about their failed download."""
-    if sys.version_info[0] == 2:
+    if isinstance(exc, requests.exceptions.RequestException):
+        url_error_msg = str(exc)
+    elif sys.version_info[0] == 2:
         url_error_msg = str(exc.strerror)
     else:
         url_error_msg = str(exc.reason)
@@ -1,4 +1,7 @@
 """Terraform version management."""
+import copy
+import hashlib
+import io
 import json
 import logging
 import os
@@ -7,21 +10,172 @@ import re
 import shutil
 import sys
 import tempfile
+import threading
 import zipfile
-from distutils.version import LooseVersion  # noqa pylint: disable=E
 
-import hcl
 import requests
-# Old pylint on py2.7 incorrectly flags these
-from six.moves.urllib.error import URLError  # pylint: disable=E
-from six.moves.urllib.request import urlretrieve  # pylint: disable=E
+from packaging.version import InvalidVersion, Version
+from requests.adapters import HTTPAdapter
 
-from ..util import cached_property, get_hash_for_filename, sha256sum
+from ..util import cached_property
 from . import EnvManager, handle_bin_download_error
 
+if sys.version_info.major > 2:
+    import concurrent.futures
+
 LOGGER = logging.getLogger(__name__)
+TF_HASH_FILENAME = '.sha256'
 TF_VERSION_FILENAME = '.terraform-version'
 
+# platform used in release file names unless one is explicitly provided
+_SYSTEM = platform.system()
+if _SYSTEM.startswith('Darwin'):
+    _DEFAULT_TF_PLATFORM = 'darwin'
+elif _SYSTEM.startswith(('Windows', 'MINGW64', 'MSYS_NT', 'CYGWIN_NT')):
+    _DEFAULT_TF_PLATFORM = 'windows'
+else:
+    _DEFAULT_TF_PLATFORM = 'linux'
+
+_RE_LATEST = re.compile(r'^latest$')
+_RE_LATEST_COLON = re.compile(r'^latest:(.*)$')
+_RE_MIN_REQUIRED = re.compile(r'^min-required$')
+_RE_NEG = re.compile(r'^!=.+')
+_RE_RELEASE_VERSION = re.compile(r'^[0-9]+\.[0-9]+\.[0-9]+(-[0-9A-Za-z.]+)?$')
+_RE_VER_EXTRACT = re.compile(r'[0-9]*\.[0-9]*(?:\.[0-9]*)?')
+
+# shared across all requests to releases.hashicorp.com so that the index,
+# archive, and checksums reuse the same keep-alive connections
+_SESSION = requests.Session()
+_SESSION.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=4,
+                                       max_retries=3))
+# parsed HashiCorp release index; populated on first use
+_TF_INDEX_CACHE = {}
+# parsed terraform blocks keyed by module path
+_TF_BLOCK_CACHE = {}
+# downloads larger than this are written to a temporary file
+_MAX_IN_MEMORY_DOWNLOAD = 256 * 1024 * 1024
+# per-thread buffers reused when downloading and extracting releases
+_IO_BUFFERS = threading.local()
+
+
+class IntegrityError(Exception):
+    """Raised when a downloaded Terraform release does not match its hash."""
+
+    def __init__(self, filename, expected, actual):
+        """Instantiate class.
+
+        Args:
+            filename (str): Name of the downloaded file.
+            expected (str): SHA256 hash listed in the release's SHA256SUMS.
+            actual (str): SHA256 hash of the downloaded file.
+
+        """
+        self.filename = filename
+        self.expected = expected
+        self.actual = actual
+        message = 'downloaded Terraform %s does not match sha256 %s' % (
+            filename, expected
+        )
+        super(IntegrityError, self).__init__(message)
+
+
+def _copy_stream(src, dest, sha256=None):
+    """Copy one file-like object to another using a reusable buffer.
+
+    Args:
+        src: Readable file-like object that supports ``readinto``.
+        dest: Writable file-like object.
+        sha256 (Optional[hashlib.sha256]): Updated with the copied data.
+
+    """
+    if not hasattr(_IO_BUFFERS, 'buffer'):
+        _IO_BUFFERS.buffer = memoryview(bytearray(1024 * 1024))
+    mem_view = _IO_BUFFERS.buffer
+    for i in iter(lambda: src.readinto(mem_view), 0):
+        dest.write(mem_view[:i])
+        if sha256:
+            sha256.update(mem_view[:i])
+
+
+def _download(url):
+    """Download a file using the shared session.
+
+    Files are kept in memory unless their size is unknown or larger than
+    ``_MAX_IN_MEMORY_DOWNLOAD``, in which case they are written to an
+    anonymous temporary file. The SHA256 hash is calculated as the file is
+    written so it does not need to be read again to be verified.
+
+    Returns:
+        Tuple[IO[bytes], str]: The downloaded file, positioned at the
+        beginning, and its SHA256 hex digest.
+
+    """
+    sha256 = hashlib.sha256()
+    # the raw stream is read directly so the content must not be encoded
+    with _SESSION.get(url, headers={'Accept-Encoding': 'identity'},
+                      stream=True) as response:
+        response.raise_for_status()
+        size = int(response.headers.get('Content-Length') or 0)
+        if 0 < size <= _MAX_IN_MEMORY_DOWNLOAD:
+            stream = io.BytesIO()
+        else:
+            stream = tempfile.TemporaryFile()
+        _copy_stream(response.raw, stream, sha256)
+    stream.seek(0)
+    return stream, sha256.hexdigest()
+
+
+def _extract_zip(zip_file, dest, executable=None):
+    """Extract the contents of a zip file to a directory.
+
+    Members are copied using a larger buffer than ``ZipFile.extractall``
+    to reduce the number of writes and their permissions are restored
+    from the archive.
+
+    Args:
+        zip_file (zipfile.ZipFile): Zip file to extract.
+        dest (Path): Directory where the contents will be extracted.
+        executable (Optional[str]): Name of a member that should always be
+            made executable.
+
+    """
+    for info in zip_file.infolist():
+        # drop any components that would place a member outside of dest
+        target = dest.joinpath(*[i for i in info.filename.split('/')
+                                 if i not in ('', '.', '..')])
+        if info.filename.endswith('/'):
+            target.mkdir(parents=True, exist_ok=True)
+            continue
+        target.parent.mkdir(parents=True, exist_ok=True)
+        with zip_file.open(info) as src, \
+                open(str(target), 'wb', 256 * 1024) as dst:
+            _copy_stream(src, dst)
+        mode = (info.external_attr >> 16) & 0o777
+        if info.filename == executable:
+            mode = (mode or 0o644) | 0o111
+        if mode:
+            os.chmod(str(target), mode)
+
+
+def _is_installed(version_dir, bin_name):
+    """Check if a Terraform version directory contains a complete install.
+
+    Versions installed by Runway have a hash file that is written once the
+    release has been verified and extracted. Versions installed by tfenv or
+    an older version of Runway are checked for the binary.
+
+    Args:
+        version_dir (Path): Directory of the Terraform version.
+        bin_name (str): Name of the Terraform binary.
+
+    Returns:
+        bool
+
+    """
+    return (version_dir / TF_HASH_FILENAME).is_file() or (
+        version_dir / bin_name
+    ).is_file()
+
 
 # Branch and local variable count will go down when py2 support is dropped
 def download_tf_release(version,  # noqa pylint: disable=too-many-locals,too-many-branches
@@ -35,66 +189,202 @@ def download_tf_release(version,  # noqa pylint: disable=too-many-locals,too-man
             os.environ.get('TFENV_ARCH') if os.environ.get('TFENV_ARCH')
             else 'amd64')
 
-    if tf_platform:
-        tfver_os = tf_platform + '_' + arch
-    else:
-        if platform.system().startswith('Darwin'):
-            tfver_os = "darwin_%s" % arch
-        elif platform.system().startswith('Windows') or (
-                platform.system().startswith('MINGW64') or (
-                    platform.system().startswith('MSYS_NT') or (
-                        platform.system().startswith('CYGWIN_NT')))):
-            tfver_os = "windows_%s" % arch
-        else:
-            tfver_os = "linux_%s" % arch
+    tfver_os = '%s_%s' % (tf_platform or _DEFAULT_TF_PLATFORM, arch)
 
-    download_dir = tempfile.mkdtemp()
     filename = "terraform_%s_%s.zip" % (version, tfver_os)
     shasums_name = "terraform_%s_SHA256SUMS" % version
     tf_url = "https://releases.hashicorp.com/terraform/" + version
 
+    urls = [tf_url + '/' + i for i in [filename, shasums_name]]
+
     try:
         LOGGER.verbose('downloading Terraform from %s...', tf_url)
-        for i in [filename, shasums_name]:
-            urlretrieve(tf_url + '/' + i,
-                        os.path.join(download_dir, i))
-    # IOError in py2; URLError in 3+
-    except (IOError, URLError) as exc:
+        if sys.version_info.major > 2:
+            # fetch the archive and its checksums concurrently so the small
+            # SHA256SUMS request is hidden behind the archive download
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=len(urls)) as executor:
+                futures = [executor.submit(_download, url) for url in urls]
+                downloads = [future.result() for future in futures]
+        else:
+            downloads = [_download(url) for url in urls]
+    except requests.exceptions.RequestException as exc:
         handle_bin_download_error(exc, 'Terraform')
-
-    tf_hash = get_hash_for_filename(filename, os.path.join(download_dir,
-                                                           shasums_name))
-    if tf_hash != sha256sum(os.path.join(download_dir, filename)):
-        LOGGER.error("downloaded Terraform %s does not match sha256 %s",
-                     filename, tf_hash)
+    (tf_zip, zip_hash), (shasums, _) = downloads
+
+    with shasums:
+        tf_hash = next((i.split()[0]
+                        for i in shasums.read().decode().splitlines()
+                        if i.rstrip().endswith(filename)), None)
+    if not tf_hash:
+        LOGGER.error("unable to find sha256 of %s in %s", filename,
+                     shasums_name)
         sys.exit(1)
+    if tf_hash != zip_hash:
+        tf_zip.close()
+        raise IntegrityError(filename, tf_hash, zip_hash)
+
+    # extract to a staging directory that is moved into place once complete
+    # so an interrupted extraction never looks like an installed version.
+    # it is unique since modules/regions can install the same version in
+    # parallel processes and hidden so tfenv does not list it as a version
+    versions_dir.mkdir(parents=True, exist_ok=True)
+    staging_dir = versions_dir / os.path.basename(
+        tempfile.mkdtemp(dir=str(versions_dir), prefix='.' + version + '.')
+    )
+    bin_name = 'terraform' + command_suffix
+    try:
+        os.chmod(str(staging_dir), 0o755)  # mkdtemp is only owner readable
+        with tf_zip:
+            tf_zipfile = zipfile.ZipFile(tf_zip)
+            _extract_zip(tf_zipfile, staging_dir, executable=bin_name)
+            tf_zipfile.close()
+        with open(str(staging_dir / TF_HASH_FILENAME), 'w') as stream:
+            stream.write(zip_hash)
+        if version_dir.exists() and not _is_installed(version_dir, bin_name):
+            # left behind by an incomplete install
+            shutil.rmtree(str(version_dir), ignore_errors=True)
+        try:
+            os.rename(str(staging_dir), str(version_dir))
+        except OSError:
+            if not _is_installed(version_dir, bin_name):
+                raise
+            LOGGER.verbose('Terraform %s was installed by another process',
+                           version)
+    finally:
+        if staging_dir.exists():
+            shutil.rmtree(str(staging_dir), ignore_errors=True)
+
+
+def _fetch_tf_index():
+    """Return the Terraform versions listed in the HashiCorp release index.
+
+    The parsed index is cached for the life of the process so multiple
+    modules do not each download it. Setting ``RUNWAY_TFENV_REFRESH`` will
+    bypass the cache.
+
+    Returns:
+        Dict[str, Any]: Terraform versions keyed by version number.
+
+    """
+    if os.getenv('RUNWAY_TFENV_REFRESH') or 'versions' not in _TF_INDEX_CACHE:
+        _TF_INDEX_CACHE['versions'] = json.loads(
+            _SESSION.get('https://releases.hashicorp.com/index.json').text
+        )['terraform']['versions']
+    return _TF_INDEX_CACHE['versions']
+
+
+def _tf_version_exists(version):
+    """Check if a Terraform version has been released.
+
+    This is much cheaper than retrieving the full release index when the
+    exact version is already known.
+
+    Returns:
+        bool: Whether the release exists on releases.hashicorp.com.
+
+    """
+    try:
+        return _SESSION.head(
+            'https://releases.hashicorp.com/terraform/%s/' % version,
+            allow_redirects=True
+        ).status_code == 200
+    except requests.exceptions.RequestException:
+        return False
 
-    tf_zipfile = zipfile.ZipFile(os.path.join(download_dir, filename))
-    version_dir.mkdir(parents=True, exist_ok=True)
-    tf_zipfile.extractall(str(version_dir))
-    tf_zipfile.close()
-    shutil.rmtree(download_dir)
-    result = version_dir / ('terraform' + command_suffix)
-    result.chmod(result.stat().st_mode | 0o0111)  # ensure it is executable
+
+def _iter_tf_versions(include_prerelease=False):
+    """Iterate over available Terraform versions in no particular order."""
+    return (i for i in _fetch_tf_index()
+            if include_prerelease or '-' not in i)
+
+
+def _tf_version_key(version):
+    """Key used to compare Terraform versions.
+
+    A few releases (e.g. ``0.11.15-oci``) are not valid PEP 440 versions.
+    These are ordered before all other versions.
+
+    """
+    try:
+        return Version(version)
+    except InvalidVersion:
+        return Version('0')
 
 
 def get_available_tf_versions(include_prerelease=False):
     """Return available Terraform versions."""
-    tf_releases = json.loads(
-        requests.get('https://releases.hashicorp.com/index.json').text
-    )['terraform']
-    tf_versions = sorted([k  # descending
-                          for k, _v in tf_releases['versions'].items()],
-                         key=LooseVersion,
-                         reverse=True)
-    if include_prerelease:
-        return tf_versions
-    return [i for i in tf_versions if '-' not in i]
+    return sorted(_iter_tf_versions(include_prerelease),  # descending
+                  key=_tf_version_key,
+                  reverse=True)
 
 
 def get_latest_tf_version(include_prerelease=False):
     """Return latest Terraform version."""
-    return get_available_tf_versions(include_prerelease)[0]
+    return max(_iter_tf_versions(include_prerelease), key=_tf_version_key)
+
+
+def _normalize_hcl2(value):
+    """Convert data parsed by python-hcl2 to the structure used by pyhcl.
+
+    python-hcl2 (>=3.0.0) represents each block as a list of dicts.
+    Depending on the version, it can also keep the quotes around strings
+    and add metadata keys (e.g. ``__is_block__``).
+
+    """
+    if isinstance(value, list) and value and all(isinstance(i, dict)
+                                                 for i in value):
+        result = {}
+        for i in value:
+            result.update(_normalize_hcl2(i))
+        return result
+    if isinstance(value, dict):
+        return {_normalize_hcl2(k): _normalize_hcl2(v)
+                for k, v in value.items() if not k.startswith('__')}
+    if isinstance(value, list):
+        return [_normalize_hcl2(i) for i in value]
+    if isinstance(value, str) and len(value) > 1 and \
+            value[0] == value[-1] == '"':
+        return value[1:-1]
+    return value
+
+
+def _tf_file_cache_key(tf_file):
+    """Identify the current contents of a Terraform file for caching.
+
+    Size is included and nanosecond mtime is used when available (not on
+    python 2) since a file can be rewritten within the mtime granularity of
+    some filesystems.
+
+    """
+    stat = tf_file.stat()
+    return (tf_file.name, getattr(stat, 'st_mtime_ns', stat.st_mtime),
+            stat.st_size)
+
+
+def _parse_terraform_block(tf_file):
+    """Parse the terraform block from a Terraform file.
+
+    Args:
+        tf_file (Path): Terraform file to parse.
+
+    Returns:
+        Dict[str, Any]
+
+    """
+    # parsers are slow to import so they are only imported once needed
+    try:  # python-hcl2 is much faster than pyhcl but is optional
+        import hcl2  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        hcl2 = None  # pylint: disable=invalid-name
+    # releases before 3.0.0 wrap every attribute value in a list
+    if not hcl2 or _tf_version_key(
+            getattr(hcl2, '__version__', '0')) < Version('3.0.0'):
+        import hcl  # pylint: disable=import-outside-toplevel
+        return hcl.loads(tf_file.read_text()).get('terraform', {})
+    return _normalize_hcl2(
+        hcl2.loads(tf_file.read_text()).get('terraform', [])
+    ) or {}
 
 
 class TFEnvManager(EnvManager):  # pylint: disable=too-few-public-methods
@@ -127,16 +417,37 @@ class TFEnvManager(EnvManager):  # pylint: disable=too-few-public-methods
     def terraform_block(self):
         """Collect Terraform configuration blocks from a Terraform module.
 
+        Parsed blocks are cached for the life of the process and reused
+        until a ``.tf`` file in the module is added, removed, or modified.
+
         Returns:
             Dict[str, Any]
 
         """
-        result = {}
-        for tf_file in self.path.glob('*.tf'):
-            tf_config = hcl.loads(tf_file.read_text())
-            result.update(tf_config.get('terraform', {}))
-        LOGGER.debug('parsed Terraform configuration: %s', json.dumps(result))
-        return result
+        tf_files = sorted(self.path.glob('*.tf'))
+        cache_key = tuple(_tf_file_cache_key(i) for i in tf_files)
+        cached = _TF_BLOCK_CACHE.get(str(self.path))
+        if cached and cached[0] == cache_key:
+            result = cached[1]
+        else:
+            if sys.version_info.major > 2 and len(tf_files) > 1:
+                # files are independent so they can be read and parsed at
+                # the same time; map preserves order for a stable merge
+                with concurrent.futures.ThreadPoolExecutor(
+                        max_workers=min(8, len(tf_files))) as executor:
+                    parsed = list(executor.map(_parse_terraform_block,
+                                               tf_files))
+            else:
+                parsed = [_parse_terraform_block(i) for i in tf_files]
+            result = {}
+            for tf_config in parsed:
+                result.update(tf_config)
+            _TF_BLOCK_CACHE[str(self.path)] = (cache_key, result)
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug('parsed Terraform configuration: %s',
+                         json.dumps(result))
+        # the parsed block is modified by consumers so the cache is copied
+        return copy.deepcopy(result)
 
     @cached_property
     def version_file(self):
@@ -163,15 +474,13 @@ class TFEnvManager(EnvManager):  # pylint: disable=too-few-public-methods
         version = self.terraform_block.get('required_version')
 
         if version:
-            if re.match(r'^!=.+', version):
+            if _RE_NEG.match(version):
                 LOGGER.error('min required Terraform version is a negation (%s) '
                              '- unable to determine required version',
                              version)
                 sys.exit(1)
             else:
-                version = re.search(
-                    r'[0-9]*\.[0-9]*(?:\.[0-9]*)?', version
-                ).group(0)
+                version = _RE_VER_EXTRACT.search(version).group(0)
                 LOGGER.debug("detected minimum Terraform version is %s",
                              version)
                 return version
@@ -180,6 +489,18 @@ class TFEnvManager(EnvManager):  # pylint: disable=too-few-public-methods
                      'files')
         sys.exit(1)
 
+    def is_installed(self, version):
+        """Check if a version of Terraform is already installed.
+
+        Args:
+            version (str): Terraform version.
+
+        Returns:
+            bool
+
+        """
+        return _is_installed(self.versions_dir / version, self._bin_name)
+
     def get_version_from_file(self, file_path=None):
         """Get Terraform version from a file.
 
@@ -196,6 +517,16 @@ class TFEnvManager(EnvManager):  # pylint: disable=too-few-public-methods
         return None
 
     def install(self, version_requested=None):
+        """Ensure Terraform is available."""
+        try:
+            return self._install(version_requested)
+        finally:
+            # modules and regions can be processed in forked processes; any
+            # idle keep-alive connection left in the pool would be inherited
+            # and shared by every child so they are dropped here
+            _SESSION.close()
+
+    def _install(self, version_requested=None):
         """Ensure Terraform is available."""
         version_requested = version_requested or self.get_version_from_file()
 
@@ -206,14 +537,16 @@ class TFEnvManager(EnvManager):  # pylint: disable=too-few-public-methods
                 )
             )
 
-        if re.match(r'^min-required$', version_requested):
+        if _RE_MIN_REQUIRED.match(version_requested):
             LOGGER.debug('tfenv: detecting minimal required version')
             version_requested = self.get_min_required()
 
-        if re.match(r'^latest:.*$', version_requested):
-            regex = re.search(r'latest:(.*)', version_requested).group(1)
+        version = None
+        latest_match = _RE_LATEST_COLON.match(version_requested)
+        if latest_match:
+            regex = latest_match.group(1)
             include_prerelease_versions = False
-        elif re.match(r'^latest$', version_requested):
+        elif _RE_LATEST.match(version_requested):
             regex = r'^[0-9]+\.[0-9]+\.[0-9]+$'
             include_prerelease_versions = False
         else:
@@ -221,25 +554,34 @@ class TFEnvManager(EnvManager):  # pylint: disable=too-few-public-methods
             include_prerelease_versions = True
             # Return early (i.e before reaching out to the internet) if the
             # matching version is already installed
-            if (self.versions_dir / version_requested).is_dir():
+            if self.is_installed(version_requested):
                 LOGGER.verbose("Terraform version %s already installed; using "
                                "it...", version_requested)
                 self.current_version = version_requested
                 return str(self.bin)
-
-        try:
-            version = next(i
-                           for i in get_available_tf_versions(
-                               include_prerelease_versions)
-                           if re.match(regex, i))
-        except StopIteration:
-            LOGGER.error("unable to find a Terraform version matching regex: %s",
-                         regex)
-            sys.exit(1)
+            # only fall back to searching the release index if the value
+            # is not an exact version (e.g. it is a regex)
+            if _RE_RELEASE_VERSION.match(version_requested) and \
+                    _tf_version_exists(version_requested):
+                version = version_requested
+
+        if not version:
+            # compiled once rather than looked up for each available version
+            pattern = re.compile(regex)
+            try:
+                version = max(
+                    (i for i in _iter_tf_versions(include_prerelease_versions)
+                     if pattern.match(i)),
+                    key=_tf_version_key
+                )
+            except ValueError:  # no matching versions
+                LOGGER.error("unable to find a Terraform version matching "
+                             "regex: %s", regex)
+                sys.exit(1)
 
         # Now that a version has been selected, skip downloading if it's
         # already been downloaded
-        if (self.versions_dir / version).is_dir():
+        if self.is_installed(version):
             LOGGER.verbose("Terraform version %s already installed; using it...",
                            version)
             self.current_version = version
@@ -247,7 +589,12 @@ class TFEnvManager(EnvManager):  # pylint: disable=too-few-public-methods
 
         LOGGER.info("downloading and using Terraform version %s ...",
                     version)
-        download_tf_release(version, self.versions_dir, self.command_suffix)
+        try:
+            download_tf_release(version, self.versions_dir,
+                                self.command_suffix)
+        except IntegrityError as exc:
+            LOGGER.error(str(exc))
+            sys.exit(1)
         LOGGER.verbose("downloaded Terraform %s successfully", version)
         self.current_version = version
         return str(self.bin)
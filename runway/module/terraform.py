@@ -645,7 +645,8 @@ class TerraformBackendConfig(ModuleOptions):
             )
             return []
         LOGGER.info('using backend values from runway.yml')
-        LOGGER.debug('provided backend values: %s', json.dumps(result))
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug('provided backend values: %s', json.dumps(result))
         return result
 
     def get_full_configuration(self):
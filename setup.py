@@ -80,6 +80,10 @@ setup(
     keywords='cli',
     packages=find_packages(exclude=('integration*', 'tests*')),
     install_requires=INSTALL_REQUIRES,
+    extras_require={
+        # faster parsing of Terraform configuration
+        'hcl2': ['python-hcl2>=3.0.0; python_version >= "3.6"']
+    },
     setup_requires=['setuptools_scm'],
     use_scm_version={"local_scheme": local_scheme},
     entry_points={
@@ -1,24 +1,211 @@
 """Test runway.env_mgr.tfenv."""
 # pylint: disable=no-self-use
+import hashlib
+import io
 import json
+import os
+import sys
+import threading
+import zipfile
 
-import hcl
 import pytest
 import six
 from mock import MagicMock, patch
 
 from runway.env_mgr.tfenv import (
+    TF_HASH_FILENAME,
     TF_VERSION_FILENAME,
+    IntegrityError,
     TFEnvManager,
+    _normalize_hcl2,
+    download_tf_release,
     get_available_tf_versions,
     get_latest_tf_version,
 )
 
+try:
+    import hcl2
+except ImportError:
+    hcl2 = None  # pylint: disable=invalid-name
+
 MODULE = 'runway.env_mgr.tfenv'
+TF_BLOCK_CONTENT = """
+terraform {
+  required_version = ">= 0.12.0"
 
+  backend "s3" {
+    bucket = "name"
 
-@patch(MODULE + '.requests')
-def test_get_available_tf_versions(mock_requests):
+    workspaces {
+      prefix = "test-"
+    }
+  }
+}
+"""
+
+
+@pytest.fixture(autouse=True)
+def clear_tf_cache(monkeypatch):
+    """Prevent cached Terraform data from leaking into tests."""
+    monkeypatch.setattr(MODULE + '._TF_BLOCK_CACHE', {})
+    monkeypatch.setattr(MODULE + '._TF_INDEX_CACHE', {})
+
+
+class MockResponse(object):
+    """Mock streamed response from requests."""
+
+    def __init__(self, content):
+        """Instantiate class."""
+        self.headers = {'Content-Length': str(len(content))}
+        self.raw = io.BytesIO(content)
+
+    def __enter__(self):
+        """Enter context manager."""
+        return self
+
+    def __exit__(self, *_args):
+        """Exit context manager."""
+
+    def raise_for_status(self):
+        """Raise for HTTP error status."""
+
+
+def build_tf_release(version, tf_platform):
+    """Build the content of a mock Terraform release.
+
+    Returns:
+        Dict[str, bytes]: Mapping of file name to file content.
+
+    """
+    filename = 'terraform_%s_%s.zip' % (version, tf_platform)
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w') as zip_file:
+        # no permissions are stored by ZipInfo by default
+        zip_file.writestr(zipfile.ZipInfo('terraform'), b'#!/bin/sh\n')
+        zip_file.writestr('LICENSE', b'license')
+    archive = archive.getvalue()
+    shasums = '%s  %s\n' % (hashlib.sha256(archive).hexdigest(), filename)
+    return {filename: archive,
+            'terraform_%s_SHA256SUMS' % version: shasums.encode()}
+
+
+@pytest.mark.parametrize('in_memory', [True, False])
+@patch(MODULE + '._SESSION')
+def test_download_tf_release(mock_session, in_memory, monkeypatch, tmp_path):
+    """Test runway.env_mgr.tfenv.download_tf_release."""
+    if not in_memory:
+        monkeypatch.setattr(MODULE + '._MAX_IN_MEMORY_DOWNLOAD', 0)
+    release = build_tf_release('0.12.0', 'linux_amd64')
+    mock_session.get.side_effect = lambda url, **_: MockResponse(
+        release[url.split('/')[-1]]
+    )
+
+    download_tf_release('0.12.0', tmp_path, '', tf_platform='linux',
+                        arch='amd64')
+    result = tmp_path / '0.12.0' / 'terraform'
+    assert result.read_bytes() == b'#!/bin/sh\n'
+    assert result.stat().st_mode & 0o0111
+    assert (tmp_path / '0.12.0' / 'LICENSE').read_bytes() == b'license'
+    assert (tmp_path / '0.12.0' / TF_HASH_FILENAME).read_text() == \
+        hashlib.sha256(release['terraform_0.12.0_linux_amd64.zip']).hexdigest()
+    assert not list(tmp_path.glob('.0.12.0.*'))
+
+
+@patch(MODULE + '._SESSION')
+def test_download_tf_release_incomplete(mock_session, tmp_path):
+    """Test runway.env_mgr.tfenv.download_tf_release with incomplete install."""
+    release = build_tf_release('0.12.0', 'linux_amd64')
+    mock_session.get.side_effect = lambda url, **_: MockResponse(
+        release[url.split('/')[-1]]
+    )
+    (tmp_path / '0.12.0').mkdir()
+    (tmp_path / '0.12.0' / 'leftover').touch()
+
+    download_tf_release('0.12.0', tmp_path, '', tf_platform='linux',
+                        arch='amd64')
+    assert sorted(i.name for i in (tmp_path / '0.12.0').iterdir()) == [
+        TF_HASH_FILENAME, 'LICENSE', 'terraform'
+    ]
+    assert not list(tmp_path.glob('.0.12.0.*'))
+
+
+@patch(MODULE + '._SESSION')
+def test_download_tf_release_concurrent(mock_session, tmp_path):
+    """Test runway.env_mgr.tfenv.download_tf_release run concurrently."""
+    release = build_tf_release('0.12.0', 'linux_amd64')
+    mock_session.get.side_effect = lambda url, **_: MockResponse(
+        release[url.split('/')[-1]]
+    )
+    start = threading.Event()
+    errors = []
+
+    def install():
+        """Wait for all threads to start then install."""
+        start.wait()
+        try:
+            download_tf_release('0.12.0', tmp_path, '', tf_platform='linux',
+                                arch='amd64')
+        except Exception as err:  # pylint: disable=broad-except
+            errors.append(err)
+
+    threads = [threading.Thread(target=install) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    start.set()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    assert sorted(i.name for i in (tmp_path / '0.12.0').iterdir()) == [
+        TF_HASH_FILENAME, 'LICENSE', 'terraform'
+    ]
+    assert not list(tmp_path.glob('.0.12.0.*'))
+
+
+@patch(MODULE + '._SESSION')
+def test_download_tf_release_installed_by_other(mock_session, tmp_path):
+    """Test runway.env_mgr.tfenv.download_tf_release installed by another."""
+    release = build_tf_release('0.12.0', 'linux_amd64')
+    mock_session.get.side_effect = lambda url, **_: MockResponse(
+        release[url.split('/')[-1]]
+    )
+    real_rename = os.rename
+
+    def rename(src, dst):
+        """Install the version in another "process" before renaming."""
+        (tmp_path / '0.12.0').mkdir()
+        (tmp_path / '0.12.0' / TF_HASH_FILENAME).write_text(u'other')
+        (tmp_path / '0.12.0' / 'terraform').touch()
+        real_rename(src, dst)
+
+    with patch(MODULE + '.os.rename', side_effect=rename):
+        download_tf_release('0.12.0', tmp_path, '', tf_platform='linux',
+                            arch='amd64')
+    assert (tmp_path / '0.12.0' / TF_HASH_FILENAME).read_text() == 'other'
+    assert not list(tmp_path.glob('.0.12.0.*'))
+
+
+@patch(MODULE + '._SESSION')
+def test_download_tf_release_hash_mismatch(mock_session, tmp_path):
+    """Test runway.env_mgr.tfenv.download_tf_release hash mismatch."""
+    release = build_tf_release('0.12.0', 'linux_amd64')
+    release['terraform_0.12.0_linux_amd64.zip'] += b'invalid'
+    mock_session.get.side_effect = lambda url, **_: MockResponse(
+        release[url.split('/')[-1]]
+    )
+
+    with pytest.raises(IntegrityError) as excinfo:
+        download_tf_release('0.12.0', tmp_path, '', tf_platform='linux',
+                            arch='amd64')
+    assert excinfo.value.filename == 'terraform_0.12.0_linux_amd64.zip'
+    assert excinfo.value.actual == hashlib.sha256(
+        release['terraform_0.12.0_linux_amd64.zip']
+    ).hexdigest()
+    assert not (tmp_path / '0.12.0').exists()
+
+
+@patch(MODULE + '._SESSION')
+def test_get_available_tf_versions(mock_session):
     """Test runway.env_mgr.tfenv.get_available_tf_versions."""
     response = {
         'terraform': {
@@ -28,22 +215,65 @@ def test_get_available_tf_versions(mock_requests):
             }
         }
     }
-    mock_requests.get.return_value = MagicMock(text=json.dumps(response))
+    mock_session.get.return_value = MagicMock(text=json.dumps(response))
     assert get_available_tf_versions() == ['0.12.0']
     assert get_available_tf_versions(include_prerelease=True) == [
-        '0.12.0-beta',
-        '0.12.0'
+        '0.12.0',
+        '0.12.0-beta'
     ]
+    mock_session.get.assert_called_once_with(
+        'https://releases.hashicorp.com/index.json'
+    )
+
+
+@patch(MODULE + '._SESSION')
+def test_get_available_tf_versions_refresh(mock_session, monkeypatch):
+    """Test runway.env_mgr.tfenv.get_available_tf_versions with refresh."""
+    monkeypatch.setenv('RUNWAY_TFENV_REFRESH', '1')
+    response = {'terraform': {'versions': {'0.12.0': {}}}}
+    mock_session.get.return_value = MagicMock(text=json.dumps(response))
+    assert get_available_tf_versions() == ['0.12.0']
+    assert get_available_tf_versions() == ['0.12.0']
+    assert mock_session.get.call_count == 2
 
 
-@patch(MODULE + '.get_available_tf_versions')
-def test_get_latest_tf_version(mock_get_available_tf_versions):
+@patch(MODULE + '._fetch_tf_index')
+def test_get_latest_tf_version(mock_fetch_tf_index):
     """Test runway.env_mgr.tfenv.get_latest_tf_version."""
-    mock_get_available_tf_versions.return_value = ['latest']
-    assert get_latest_tf_version() == 'latest'
-    mock_get_available_tf_versions.assert_called_once_with(False)
-    assert get_latest_tf_version(include_prerelease=True) == 'latest'
-    mock_get_available_tf_versions.assert_called_with(True)
+    mock_fetch_tf_index.return_value = {
+        '0.9.11': {},
+        '0.11.15-oci': {},
+        '0.12.0': {},
+        '0.12.1-beta': {}
+    }
+    assert get_latest_tf_version() == '0.12.0'
+    assert get_latest_tf_version(include_prerelease=True) == '0.12.1-beta'
+
+
+@pytest.mark.parametrize('parsed', [
+    # python-hcl2 3.x
+    [{'required_version': '>= 0.12.0',
+      'backend': [{'s3': {'bucket': 'name',
+                          'workspaces': [{'prefix': 'test-'}]}}]}],
+    # python-hcl2 7.x+
+    [{'required_version': '">= 0.12.0"',
+      'backend': [{'"s3"': {'bucket': '"name"',
+                            'workspaces': [{'prefix': '"test-"',
+                                            '__is_block__': True}],
+                            '__is_block__': True}}],
+      '__is_block__': True}]
+])
+def test_normalize_hcl2(parsed):
+    """Test runway.env_mgr.tfenv._normalize_hcl2."""
+    assert _normalize_hcl2(parsed) == {
+        'backend': {
+            's3': {
+                'bucket': 'name',
+                'workspaces': {'prefix': 'test-'}
+            }
+        },
+        'required_version': '>= 0.12.0'
+    }
 
 
 class TestTFEnvManager(object):
@@ -112,7 +342,8 @@ class TestTFEnvManager(object):
         version_file.write_text(six.u('0.12.0'))
         assert tfenv.get_version_from_file(version_file) == '0.12.0'
 
-    @patch(MODULE + '.get_available_tf_versions')
+    @patch(MODULE + '._tf_version_exists', MagicMock(return_value=False))
+    @patch(MODULE + '._iter_tf_versions')
     @patch(MODULE + '.download_tf_release')
     def test_install(self, mock_download,
                      mock_available_versions, monkeypatch, tmp_path):
@@ -136,16 +367,18 @@ class TestTFEnvManager(object):
         )
         assert tfenv.current_version == '0.11.5'
 
-    @patch(MODULE + '.get_available_tf_versions')
+    @patch(MODULE + '._SESSION')
+    @patch(MODULE + '._iter_tf_versions')
     @patch(MODULE + '.download_tf_release')
     def test_install_already_installed(self, mock_download,
                                        mock_available_versions,
-                                       monkeypatch, tmp_path):
+                                       mock_session, monkeypatch, tmp_path):
         """Test install with version already installed."""
         mock_available_versions.return_value = ['0.12.0']
         monkeypatch.setattr(TFEnvManager, 'versions_dir', tmp_path)
         tfenv = TFEnvManager(tmp_path)
         (tfenv.versions_dir / '0.12.0').mkdir()
+        (tfenv.versions_dir / '0.12.0' / TF_HASH_FILENAME).touch()
 
         assert tfenv.install('0.12.0')
         mock_available_versions.assert_not_called()
@@ -153,8 +386,43 @@ class TestTFEnvManager(object):
         assert tfenv.current_version == '0.12.0'
 
         assert tfenv.install(r'0\.12\..*')  # regex does not match dir
+        mock_session.head.assert_not_called()
+
+    @patch(MODULE + '._tf_version_exists', MagicMock(return_value=True))
+    @patch(MODULE + '._iter_tf_versions')
+    @patch(MODULE + '.download_tf_release')
+    def test_install_exact_version(self, mock_download,
+                                   mock_available_versions, monkeypatch,
+                                   tmp_path):
+        """Test install with an exact version that exists."""
+        monkeypatch.setattr(TFEnvManager, 'versions_dir', tmp_path)
+        tfenv = TFEnvManager(tmp_path)
+
+        with patch(MODULE + '._SESSION') as mock_session:
+            assert tfenv.install('0.12.0')
+        mock_session.close.assert_called_once_with()
+        mock_available_versions.assert_not_called()
+        mock_download.assert_called_once_with(
+            '0.12.0', tfenv.versions_dir, tfenv.command_suffix
+        )
+        assert tfenv.current_version == '0.12.0'
+
+    @patch(MODULE + '._tf_version_exists', MagicMock(return_value=True))
+    @patch(MODULE + '.download_tf_release')
+    def test_install_integrity_error(self, mock_download, monkeypatch,
+                                     tmp_path):
+        """Test install with a release that does not match its hash."""
+        mock_download.side_effect = IntegrityError('terraform.zip', 'abc',
+                                                   'def')
+        monkeypatch.setattr(TFEnvManager, 'versions_dir', tmp_path)
+        tfenv = TFEnvManager(tmp_path)
+
+        with pytest.raises(SystemExit) as excinfo:
+            assert tfenv.install('0.12.0')
+        assert excinfo.value.code == 1
+        assert not tfenv.current_version
 
-    @patch(MODULE + '.get_available_tf_versions')
+    @patch(MODULE + '._iter_tf_versions')
     @patch(MODULE + '.download_tf_release')
     def test_install_latest(self, mock_download, mock_available_versions,
                             monkeypatch, tmp_path):
@@ -177,7 +445,8 @@ class TestTFEnvManager(object):
         )
         assert tfenv.current_version == '0.11.5'
 
-    @patch(MODULE + '.get_available_tf_versions')
+    @patch(MODULE + '._tf_version_exists', MagicMock(return_value=False))
+    @patch(MODULE + '._iter_tf_versions')
     @patch(MODULE + '.download_tf_release')
     def test_install_min_required(self, mock_download, mock_available_versions,
                                   monkeypatch, tmp_path):
@@ -207,7 +476,8 @@ class TestTFEnvManager(object):
             'version not provided and unable to find a .terraform-version file'
         )
 
-    @patch(MODULE + '.get_available_tf_versions')
+    @patch(MODULE + '._tf_version_exists', MagicMock(return_value=False))
+    @patch(MODULE + '._iter_tf_versions')
     @patch(MODULE + '.download_tf_release')
     def test_install_unavailable(self, mock_download, mock_available_versions,
                                  monkeypatch, tmp_path):
@@ -223,22 +493,81 @@ class TestTFEnvManager(object):
         mock_download.assert_not_called()
         assert not tfenv.current_version
 
-    def test_terraform_block(self, tmp_path):
+    def test_is_installed(self, monkeypatch, tmp_path):
+        """Test is_installed."""
+        monkeypatch.setattr(TFEnvManager, 'versions_dir', tmp_path)
+        tfenv = TFEnvManager(tmp_path)
+        version_dir = tmp_path / '0.12.0'
+        bin_path = version_dir / ('terraform' + tfenv.command_suffix)
+
+        assert not tfenv.is_installed('0.12.0')
+        version_dir.mkdir()
+        assert not tfenv.is_installed('0.12.0')  # incomplete
+        bin_path.touch()
+        assert tfenv.is_installed('0.12.0')  # installed by tfenv
+        bin_path.unlink()
+        (version_dir / TF_HASH_FILENAME).touch()
+        assert tfenv.is_installed('0.12.0')
+
+    @pytest.mark.parametrize('use_hcl2', [False, True])
+    def test_terraform_block(self, use_hcl2, monkeypatch, tmp_path):
         """Test terraform_block."""
-        content = {
-            'terraform': {
-                'backend': {
-                    's3': {
-                        'bucket': 'name'
-                    }
+        if not use_hcl2:
+            monkeypatch.setitem(sys.modules, 'hcl2', None)
+        elif not hcl2:
+            pytest.skip('python-hcl2 is not installed')
+        tf_file = tmp_path / 'module.tf'
+        tf_file.write_text(six.u(TF_BLOCK_CONTENT))
+        (tmp_path / 'variables.tf').write_text(six.u('variable "test" {}'))
+        tfenv = TFEnvManager(tmp_path)
+
+        assert tfenv.terraform_block == {
+            'backend': {
+                's3': {
+                    'bucket': 'name',
+                    'workspaces': {'prefix': 'test-'}
                 }
-            }
+            },
+            'required_version': '>= 0.12.0'
         }
-        tf_file = tmp_path / 'module.tf'
-        tf_file.write_text(six.u(hcl.dumps(content)))
+
+    def test_terraform_block_unsupported_hcl2(self, monkeypatch, tmp_path):
+        """Test terraform_block falls back to pyhcl for old python-hcl2."""
+        mock_hcl2 = MagicMock(__version__='2.0.3')
+        monkeypatch.setitem(sys.modules, 'hcl2', mock_hcl2)
+        (tmp_path / 'module.tf').write_text(six.u(TF_BLOCK_CONTENT))
         tfenv = TFEnvManager(tmp_path)
 
-        assert tfenv.terraform_block == content['terraform']
+        assert tfenv.terraform_block['required_version'] == '>= 0.12.0'
+        mock_hcl2.loads.assert_not_called()
+
+    @patch(MODULE + '._parse_terraform_block')
+    def test_terraform_block_cached(self, mock_parse, tmp_path):
+        """Test terraform_block is cached between instances."""
+        mock_parse.return_value = {'backend': {'s3': {'bucket': 'name'}}}
+        tf_file = tmp_path / 'module.tf'
+        tf_file.write_text(six.u('terraform {}'))
+
+        tfenv = TFEnvManager(tmp_path)
+        tfenv.terraform_block['backend']['s3']['key'] = 'modified'
+        assert TFEnvManager(tmp_path).terraform_block == {
+            'backend': {'s3': {'bucket': 'name'}}
+        }
+        mock_parse.assert_called_once_with(tf_file)
+
+        (tmp_path / 'other.tf').write_text(six.u('variable "test" {}'))
+        assert TFEnvManager(tmp_path).terraform_block
+        assert mock_parse.call_count == 3
+
+        # same mtime but different content
+        stat = tf_file.stat()
+        tf_file.write_text(six.u('terraform {\n}'))
+        if hasattr(stat, 'st_mtime_ns'):
+            os.utime(str(tf_file), ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        else:
+            os.utime(str(tf_file), (stat.st_atime, stat.st_mtime))
+        assert TFEnvManager(tmp_path).terraform_block
+        assert mock_parse.call_count == 5
 
     def test_version_file(self, tmp_path):
         """Test version_file."""